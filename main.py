@@ -1,15 +1,46 @@
 """
-Sticker Booth — Multi-image, sequential generation with processing/print flow.
+Sticker Booth — Multi-image, concurrent generation with processing/print flow.
 
 This version adds thorough, practical comments explaining what each block does,
-key security considerations, and places to extend the app safely. Functionality
-is unchanged from the original.
+key security considerations, and places to extend the app safely. Beyond the
+original flow it keeps per-browser state server-side under a plain `sid` cookie,
+spools session media to disk, serves images from /img, streams job progress over
+server-sent events (/api/gen-stream), and can submit jobs through the OpenAI Batch
+API (USE_BATCH_API).
 """
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-import base64, uuid, time, os, subprocess, shutil, threading
-from datetime import datetime
-from openai import OpenAI
+from flask import Flask, Response, render_template, request, jsonify, g, redirect, url_for, send_file
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import ClientDisconnected
+import asyncio, binascii, hashlib, heapq, io, json, secrets, time, os, subprocess, shutil, tempfile, threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from PIL import Image
+
+# Prefer pybase64 (SIMD codecs) for the multi-MB image payloads; the stdlib is a drop-in fallback
+try:
+    from pybase64 import b64decode, b64encode
+except Exception:
+    from base64 import b64decode
+
+    def b64encode(s: bytes) -> bytes:
+        # b2a_base64 directly: base64.b64encode is a wrapper around it
+        return binascii.b2a_base64(s, newline=False)
+
+# orjson (C, SIMD string escaping) serializes/parses JSON several times faster than the stdlib
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# HTTP/2 lets concurrent OpenAI calls share one connection; httpx needs the h2 package for it
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except Exception:
+    HTTP2_AVAILABLE = False
 
 # load .env if python-dotenv is installed so local dev can use a .env file
 try:
@@ -23,9 +54,31 @@ except Exception:
 # App & Config
 # -------------------
 app = Flask(__name__)
-# Secret key is required for signed cookies (Flask sessions). In production, set APP_SECRET_KEY.
-app.secret_key = os.environ.get("APP_SECRET_KEY", "change-it")
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; jsonify() and request.json both use it.
+
+    Output matches the default provider's compact form (sorted keys, no spaces), and
+    responses are built straight from orjson's bytes with no intermediate str.
+    """
+
+    def _option(self, sort_keys: bool) -> int:
+        return orjson.OPT_SORT_KEYS if sort_keys else 0
+
+    def dumps(self, obj, **kwargs) -> str:
+        sort_keys = kwargs.get("sort_keys", self.sort_keys)
+        return orjson.dumps(obj, default=self.default, option=self._option(sort_keys)).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._option(self.sort_keys))
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 # Security & limits — keep request bodies small and cookies hardened
 app.config.update(
     MAX_CONTENT_LENGTH=5 * 1024 * 1024,  # limit request bodies to ~5MB to mitigate abuse
@@ -34,30 +87,289 @@ app.config.update(
     SESSION_COOKIE_SECURE=(os.environ.get("SESSION_COOKIE_SECURE", "0") == "1"),  # set to 1 behind HTTPS
 )
 
-# In-memory store scoped by session id; nothing is written to disk for PII minimization
-STORE: dict[str, dict] = {}
+# The only per-browser state is an opaque, random session id, so it travels in a plain cookie
+# rather than Flask's signed session: no serializer or HMAC on every request. The id is an
+# unguessable 128-bit token that is only honored while its session exists server-side.
+SID_COOKIE = "sid"
 
 # Idle session TTL (seconds). Default 10 minutes.
 SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "600"))
 
+class Session:
+    """One browser's booth state (photo, style choice, generation job, outputs).
+
+    Uses __slots__: a fixed inline layout instead of a per-instance dict, so each idle
+    session costs far less memory and field typos fail loudly instead of adding keys.
+    """
+
+    __slots__ = (
+        "captured_path", "captured_mime", "selected_style", "selected_prompt",
+        "generated_paths", "generated_mime", "approved_paths", "approved_mime",
+        "approved_version", "gen_status", "gen_progress", "gen_error", "batch_id",
+        "gen_future", "gen_key", "generated_key", "generated_alt", "gen_changed",
+    )
+
+    def __init__(self) -> None:
+        # Not part of reset(): open /api/gen-stream responses keep waiting on this one
+        self.gen_changed = threading.Condition()
+        self.reset()
+
+    def notify(self) -> None:
+        """Wake /api/gen-stream waiters; call after changing gen_status/gen_progress/gen_error."""
+        with self.gen_changed:
+            self.gen_changed.notify_all()
+
+    def reset(self) -> None:
+        """Return every field to its fresh-session default."""
+        self.captured_path: str | None = None
+        self.captured_mime = "image/png"
+        self.selected_style: str | None = None
+        self.selected_prompt: str | None = None
+        self.generated_paths: list[str] | None = None
+        self.generated_mime = "image/png"
+        self.approved_paths: list[str] | None = None
+        self.approved_mime = "image/png"
+        self.approved_version: str | None = None
+        self.gen_status = "idle"
+        self.gen_progress = 0
+        self.gen_error: str | None = None
+        self.batch_id: str | None = None
+        self.gen_future = None  # concurrent.futures.Future of the job's task on GEN_LOOP
+        self.gen_key: tuple | None = None  # inputs of the last started job (see generate-multi-start)
+        self.generated_key: tuple | None = None  # gen_key of the job whose outputs are staged
+        self.generated_alt: list[list[str]] | None = None  # unshown spooled variants per image
+
+class SessionStore:
+    """Per-session state keyed by sid, behind a small get/set/pop/ping interface.
+
+    Backed by a process-local dict. Large blobs (captured photo, generated stickers) are
+    spooled to a private per-session temp dir (see _tmp_write) deleted with the session.
+    Generation jobs (and their Futures) also live in this process, so a shared backend
+    such as Redis would need a shared job queue as well — until then, run one worker
+    process (threads are fine). Routes only use this interface so the backend can change.
+
+    Expiry uses a min-heap of (expiry_ts, sid): each set/ping pushes a fresh entry and
+    records it in a small sid → expiry map; older entries for the same sid go stale and
+    are skipped when popped (lazy deletion), so purging never scans every session and
+    never touches the Session records themselves.
+
+    Sessions are also kept in LRU order, with the size of each one's spooled media
+    tracked, so pop_over_budget() and pop_over_count() can evict the least recently
+    active sessions when the spool outgrows its byte cap or the store its session cap.
+
+    Mutations take a lock: request threads and the background purge thread both write.
+    """
+
+    def __init__(self, ttl_seconds: int) -> None:
+        self._data: OrderedDict[str, Session] = OrderedDict()  # least recently active first
+        self._media: dict[str, dict[str, int]] = {}  # sid → {spooled path: size}
+        self._media_bytes = 0
+        self._expiry: dict[str, float] = {}
+        self._expiry_heap: list[tuple[float, str]] = []
+        self._lock = threading.Lock()
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, sid: str, default=None):
+        return self._data.get(sid, default)
+
+    def set(self, sid: str, state: Session) -> None:
+        with self._lock:
+            self._data[sid] = state
+            self._data.move_to_end(sid)
+            self._schedule(sid)
+
+    def pop(self, sid: str, default=None):
+        with self._lock:
+            state = self._data.get(sid, default)
+            self._drop(sid)
+            return state
+
+    def ping(self, sid: str) -> None:
+        """Refresh the last-activity timestamp of a live session; no-op for unknown ids."""
+        with self._lock:
+            if sid in self._data:
+                self._data.move_to_end(sid)
+                self._schedule(sid)
+
+    def track_media(self, sid: str, path: str, size: int) -> None:
+        """Record (or update) the size of a file spooled for a live session."""
+        with self._lock:
+            if sid not in self._data:
+                return
+            files = self._media.setdefault(sid, {})
+            self._media_bytes += size - files.get(path, 0)
+            files[path] = size
+
+    def drop_media(self, sid: str) -> None:
+        """Forget a session's spooled files (after they were deleted)."""
+        with self._lock:
+            self._media_bytes -= sum(self._media.pop(sid, {}).values())
+
+    def pop_over_budget(self, max_bytes: int, keep: str) -> list[tuple[str, Session]]:
+        """Evict least recently active sessions until spooled media fits `max_bytes`.
+
+        Never evicts `keep` (the session that is writing). Returns the evicted
+        (sid, Session) pairs so the caller can stop their jobs and delete their files.
+        """
+        evicted: list[tuple[str, Session]] = []
+        with self._lock:
+            if self._media_bytes <= max_bytes:
+                return evicted
+            for sid in list(self._data):
+                if self._media_bytes <= max_bytes:
+                    break
+                if sid != keep and sid in self._media:
+                    evicted.append((sid, self._data[sid]))
+                    self._drop(sid)
+        return evicted
+
+    def pop_over_count(self, max_sessions: int, keep: str) -> list[tuple[str, Session]]:
+        """Evict sessions until at most `max_sessions` remain.
+
+        Sessions with no spooled media (nothing captured yet, e.g. a bare page view) go
+        first, least recently active first, so a burst of cookie-less requests can't push
+        out guests mid-flow; only then are guests evicted in LRU order. Never evicts
+        `keep` (the session just created). Returns the evicted (sid, Session) pairs.
+        """
+        evicted: list[tuple[str, Session]] = []
+        with self._lock:
+            excess = len(self._data) - max_sessions
+            if excess <= 0:
+                return evicted
+            victims = [sid for sid in self._data if sid != keep and sid not in self._media][:excess]
+            if len(victims) < excess:
+                chosen = set(victims)
+                victims += [sid for sid in self._data if sid != keep and sid not in chosen][:excess - len(victims)]
+            for sid in victims:
+                evicted.append((sid, self._data[sid]))
+                self._drop(sid)
+        return evicted
+
+    def pop_expired(self, now: float) -> list[tuple[str, Session]]:
+        """Drop sessions idle past the TTL and return the (sid, Session) pairs; O(log N) per heap entry."""
+        expired: list[tuple[str, Session]] = []
+        with self._lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] < now:
+                exp, sid = heapq.heappop(heap)
+                # Skip stale entries: the session was touched again (newer exp) or is already gone
+                if self._expiry.get(sid) == exp:
+                    expired.append((sid, self._data[sid]))
+                    self._drop(sid)
+        return expired
+
+    def _drop(self, sid: str) -> None:
+        # Caller holds the lock
+        self._expiry.pop(sid, None)
+        self._data.pop(sid, None)
+        self._media_bytes -= sum(self._media.pop(sid, {}).values())
+
+    def _schedule(self, sid: str) -> None:
+        exp = time.time() + self.ttl_seconds
+        self._expiry[sid] = exp
+        heapq.heappush(self._expiry_heap, (exp, sid))
+
+    def __contains__(self, sid: str) -> bool:
+        return sid in self._data
+
+    def __getitem__(self, sid: str) -> Session:
+        return self._data[sid]
+
+# In-memory store scoped by session id
+STORE = SessionStore(SESSION_TTL_SECONDS)
+# Cap on live sessions; past it sessions are evicted, ones with nothing captured first (bounds
+# memory between sweeps when many browsers arrive at once)
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "1000"))
+
+# Captures are downscaled to this max edge before spooling; the same photo is uploaded
+# with each of the 4 edits, so bandwidth and model decode savings compound
+CAPTURE_MAX_EDGE = int(os.environ.get("CAPTURE_MAX_EDGE", "1024"))
+# Captures over this many pixels are rejected before any decode: a small, highly compressible
+# upload could otherwise expand to gigabytes of pixel data
+CAPTURE_MAX_PIXELS = 4096 * 4096
+
+# Per-session spool dir for session images; keeps multi-MB bytes out of the heap until needed
+MEDIA_ROOT = os.path.join(tempfile.gettempdir(), "booth")
+# Byte cap for all spooled session media; past it the least recently active sessions are evicted
+MAX_STORE_BYTES = int(os.environ.get("MAX_STORE_BYTES", str(512 * 1024 ** 2)))
+
+def _tmp_write(sid: str, name: str, data: bytes) -> str:
+    """Write session media to MEDIA_ROOT/<sid>/<name>.png (owner-only) and return its path."""
+    session_dir = os.path.join(MEDIA_ROOT, sid)
+    os.makedirs(session_dir, mode=0o700, exist_ok=True)
+    path = os.path.join(session_dir, f"{name}.png")
+    with open(path, "wb") as f:
+        f.write(data)
+    STORE.track_media(sid, path, len(data))
+    _evict(STORE.pop_over_budget(MAX_STORE_BYTES, keep=sid))
+    return path
+
+def _tmp_write_b64(sid: str, name: str, text: str, start: int = 0) -> str:
+    """Decode base64 `text[start:]` into MEDIA_ROOT/<sid>/<name>.png chunk by chunk.
+
+    Only one 64 KB chunk of decoded bytes exists at a time, so the full file is never
+    materialized in memory. Raises on invalid base64 (the partial file is removed).
+    Used for the transient print sheet, so it isn't counted against MAX_STORE_BYTES.
+    """
+    session_dir = os.path.join(MEDIA_ROOT, sid)
+    os.makedirs(session_dir, mode=0o700, exist_ok=True)
+    path = os.path.join(session_dir, f"{name}.png")
+    step = 64 * 1024  # multiple of 4, so every chunk boundary is a base64 quantum boundary
+    try:
+        with open(path, "wb") as f:
+            for i in range(start, len(text), step):
+                f.write(b64decode(text[i:i + step], validate=True))
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+def _tmp_drop(sid: str) -> None:
+    """Delete every spooled file for a session (no lingering PII on disk)."""
+    shutil.rmtree(os.path.join(MEDIA_ROOT, sid), ignore_errors=True)
+    STORE.drop_media(sid)
+
+def _evict(evicted: list[tuple[str, Session]]) -> None:
+    """Clean up sessions the store evicted: stop their jobs, then delete their files."""
+    for sid, state in evicted:
+        _cancel_job(state)
+        state.notify()  # lets an open status stream see the session is gone
+        _tmp_drop(sid)
+
+# How often the background sweeper purges idle sessions (seconds)
+PURGE_INTERVAL_SECONDS = 30
+
 def purge_expired() -> None:
-    """Remove idle sessions to free memory and avoid unbounded growth.
+    """Remove idle sessions (and their spooled files) to free memory and disk.
 
-    NOTE: This runs opportunistically on each request via a before_request hook.
+    NOTE: This runs on the background sweeper thread, not on the request path.
     """
-    now = time.time()
-    for sid, s in list(STORE.items()):
-        ts = s.get("ts", now)
-        if now - ts > SESSION_TTL_SECONDS:
-            STORE.pop(sid, None)
+    _evict(STORE.pop_expired(time.time()))
+
+def _purge_loop() -> None:
+    """Sweeper thread body: purge every PURGE_INTERVAL_SECONDS for the life of the process."""
+    while True:
+        try:
+            purge_expired()
+        except Exception:
+            # Never let one bad sweep kill the sweeper
+            pass
+        time.sleep(PURGE_INTERVAL_SECONDS)
+
+# daemon=True so the sweeper never blocks shutdown
+threading.Thread(target=_purge_loop, name="session-sweeper", daemon=True).start()
+
+# Endpoints that never read session state; they shouldn't pay for (or count as) activity
+_NO_SESSION_ENDPOINTS = frozenset({"static", "printer_info"})
 
 @app.before_request
-def _touch_and_purge() -> None:
-    """Refresh last-activity timestamp and purge idle sessions on every request."""
-    purge_expired()
-    sid = session.get("sid")
-    if sid in STORE:
-        STORE[sid]["ts"] = time.time()
+def _touch_session() -> None:
+    """Refresh the last-activity timestamp; expiry itself happens on the sweeper thread."""
+    if request.endpoint in _NO_SESSION_ENDPOINTS:
+        return
+    sid = _cookie_sid()
+    if sid:
+        STORE.ping(sid)
 
 # -------------------
 # OpenAI Client (REQUIRED)
@@ -66,7 +378,131 @@ def _touch_and_purge() -> None:
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is required. Set it in the environment before starting the app.")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+# Explicit connection pool settings: keep-alive (plus HTTP/2 when available) amortizes TLS
+# handshakes across calls and sessions. Image edits are slow, hence the generous read timeout.
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+OPENAI_HTTP_TIMEOUT = httpx.Timeout(float(os.environ.get("OPENAI_TIMEOUT_SECONDS", "120")), connect=5.0)
+# Retries with backoff are handled by the SDK itself
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))
+
+# Long-lived sync client (batch/file APIs) sharing one pool across all requests
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=OPENAI_MAX_RETRIES,
+    http_client=httpx.Client(http2=HTTP2_AVAILABLE, limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT),
+)
+
+# One background event loop runs every generation job: all in-flight edits, across all
+# sessions, are multiplexed on a single thread instead of an OS thread per job
+GEN_LOOP = asyncio.new_event_loop()
+threading.Thread(target=GEN_LOOP.run_forever, name="gen-loop", daemon=True).start()
+
+# Long-lived async client for the edits. It is only ever used on GEN_LOOP, so its pool (and
+# HTTP/2 connections) is shared by all jobs and stays warm between them.
+aclient = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=OPENAI_MAX_RETRIES,
+    http_client=httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT),
+)
+
+# Output size for every edit (and shown in templates); read once rather than per call
+GEN_SIZE = os.environ.get("GEN_SIZE", "1024x1024")
+
+# Max image edits in flight per generation job; lower it if you hit OpenAI rate limits
+GEN_CONCURRENCY = int(os.environ.get("GEN_CONCURRENCY", "4"))
+
+# Opt-in: submit the 4 edits as one OpenAI Batch job (server-side, ~50% cost, up to 24h SLA)
+# instead of running them from a worker thread. Only suitable for non-interactive flows.
+USE_BATCH_API = (os.environ.get("USE_BATCH_API", "0") == "1")
+
+# Variants requested per edit (the API's n=). Extras come back in the same round trip and are
+# spooled with the session, so resubmitting the same inputs ("try again") shows the next one
+# without another call; once they run out, a retry generates afresh. Each variant is billed
+# as an image, so this is opt-in.
+GEN_VARIANTS = max(1, int(os.environ.get("GEN_VARIANTS", "1")))
+
+# Caps concurrent generation jobs (and their image buffers) under load; extra jobs wait for a
+# slot on GEN_LOOP. At most GEN_WORKERS × GEN_CONCURRENCY edits share aclient's pool.
+GEN_WORKERS = int(os.environ.get("GEN_WORKERS", "8"))
+GEN_JOB_SLOTS = asyncio.Semaphore(GEN_WORKERS)
+
+# -------------------
+# Generation result cache
+# -------------------
+# Regenerating with the same photo, style and prompts would repeat 4 paid edits; instead the
+# outputs can be kept on disk under a hash of those inputs. Opt-in (set GEN_CACHE_MAX_BYTES,
+# e.g. 2 GB): entries hold guests' likenesses, aren't tied to a session, and so outlive
+# /reset, printing and the session sweeper — only enable it where that retention is acceptable.
+GEN_CACHE_DIR = os.environ.get("GEN_CACHE_DIR", os.path.join(tempfile.gettempdir(), "booth-cache"))
+GEN_CACHE_MAX_BYTES = int(os.environ.get("GEN_CACHE_MAX_BYTES", "0"))
+_gen_cache_lock = threading.Lock()
+
+def _gen_cache_dir(img: bytes, style_key: str, user_prompts: list[str], size: str) -> str | None:
+    """Return the cache dir for one job's inputs, or None when caching is disabled."""
+    if GEN_CACHE_MAX_BYTES <= 0:
+        return None
+    h = hashlib.sha256(img)
+    for part in (style_key, "\0".join(user_prompts), size):
+        h.update(b"|" + part.encode())
+    key = h.hexdigest()
+    return os.path.join(GEN_CACHE_DIR, key[:2], key)
+
+def _gen_cache_get(cache_dir: str | None, i: int) -> list[str] | None:
+    """Return the cached variants of output `i`, refreshing the entry's mtime for LRU eviction."""
+    if cache_dir is None:
+        return None
+    variants: list[str] = []
+    try:
+        for v in range(GEN_VARIANTS):
+            with open(os.path.join(cache_dir, f"{i}-{v}.b64"), "r", encoding="ascii") as f:
+                variants.append(f.read())
+    except OSError:
+        pass  # fewer variants cached than requested; use what's there
+    if not variants:
+        return None
+    try:
+        os.utime(cache_dir)
+    except OSError:
+        pass
+    return variants
+
+def _gen_cache_put(cache_dir: str | None, i: int, variants: list[str]) -> None:
+    """Atomically store every variant of output `i`; a failed write only costs a future cache miss."""
+    if cache_dir is None:
+        return
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        for v, gen_b64 in enumerate(variants):
+            path = os.path.join(cache_dir, f"{i}-{v}.b64")
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="ascii") as f:
+                f.write(gen_b64)
+            os.replace(tmp, path)  # readers never see a half-written file
+    except OSError:
+        pass
+
+def _gen_cache_evict() -> None:
+    """Drop least-recently-used entries (by dir mtime) until the cache fits GEN_CACHE_MAX_BYTES."""
+    entries = []
+    total = 0
+    with _gen_cache_lock:
+        try:
+            for shard in os.scandir(GEN_CACHE_DIR):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                    total += size
+        except OSError:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= GEN_CACHE_MAX_BYTES:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
 
 # -------------------
 # Style prompts / labels
@@ -94,30 +530,111 @@ STYLE_KEY_TO_HUMAN = {
     "text_icons": "Text & Icons",
 }
 
+# A short prefix to guide consistent sticker output across styles
+SYS_PREFIX = (
+    "You are an expert sticker-maker. Produce one high-quality PNG suitable for printing stickers. "
+    "Prefer transparent backgrounds when applicable. Keep the subject centered and sharp."
+)
+
+# Everything in an edit prompt except the per-image tweak is constant per style, so build it once
+STYLE_PROMPT_PREFIX: dict[str, str] = {
+    key: (
+        f"{SYS_PREFIX}\n"
+        f"Style: {STYLE_KEY_TO_HUMAN[key]}\n"
+        f"Instructions: {STYLE_PROMPTS[key]}\n\n"
+        f"Additional requirement: "
+    )
+    for key in STYLE_PROMPTS
+}
+
+# Template-ready values per style, so views pass one prebuilt dict instead of assembling it
+STYLE_META: dict[str, dict[str, str]] = {
+    key: {"style_label": STYLE_KEY_TO_HUMAN[key], "base_prompt": STYLE_PROMPTS[key]}
+    for key in STYLE_PROMPTS
+}
+
 # -------------------
 # Template globals (dynamic year, generation size knob)
 # -------------------
+_TEMPLATE_GLOBALS = {"current_year": 0, "GEN_SIZE": GEN_SIZE}
+_YEAR_ENDS_AT = 0.0
+
 @app.context_processor
 def inject_globals():
-    """Provide small global values for Jinja templates (e.g., footer year, image size)."""
-    return {
-        "current_year": datetime.utcnow().year,               # keep UTC to avoid TZ surprises
-        "GEN_SIZE": os.environ.get("GEN_SIZE", "1024x1024"),  # allow overriding via env
-    }
+    """Provide small global values for Jinja templates (e.g., footer year, image size).
+
+    Built once and reused on every render; the year is only recomputed when it rolls over.
+    """
+    global _YEAR_ENDS_AT
+    if time.time() >= _YEAR_ENDS_AT:
+        year = datetime.now(timezone.utc).year  # keep UTC to avoid TZ surprises
+        _TEMPLATE_GLOBALS["current_year"] = year
+        _YEAR_ENDS_AT = datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp()
+    return _TEMPLATE_GLOBALS
 
 # -------------------
 # Helpers
 # -------------------
 
-def get_sid() -> str:
-    """Fetch or create a stable per-browser session id and ensure backing store exists."""
-    sid = session.get("sid")
-    if not sid:
-        sid = uuid.uuid4().hex
-        session["sid"] = sid
-    if sid not in STORE:
-        STORE[sid] = {}
-    return sid
+def _cookie_sid() -> str | None:
+    """Return the sid cookie if it is well-formed (32 hex chars); it is used in spool paths."""
+    sid = request.cookies.get(SID_COOKIE)
+    if sid and len(sid) == 32 and all(c in "0123456789abcdef" for c in sid):
+        return sid
+    return None
+
+def get_sid() -> tuple[str, Session]:
+    """Fetch or create a stable per-browser session id and return it with its Session.
+
+    Returning the record too saves callers a second STORE lookup. Ids the server doesn't
+    know (expired, or client-chosen) are replaced with a fresh one rather than adopted.
+    """
+    sid = _cookie_sid()
+    store = STORE.get(sid) if sid else None
+    if store is None:
+        sid = secrets.token_hex(16)
+        store = Session()
+        STORE.set(sid, store)
+        _evict(STORE.pop_over_count(MAX_SESSIONS, keep=sid))
+        g.new_sid = sid  # sent back by _set_sid_cookie
+    return sid, store
+
+@app.after_request
+def _set_sid_cookie(resp):
+    """Issue the cookie for a session minted during this request."""
+    sid = g.pop("new_sid", None)
+    if sid:
+        resp.set_cookie(
+            SID_COOKIE, sid,
+            httponly=app.config["SESSION_COOKIE_HTTPONLY"],
+            samesite=app.config["SESSION_COOKIE_SAMESITE"],
+            secure=app.config["SESSION_COOKIE_SECURE"],
+        )
+    return resp
+
+def _data_url(mime: str, img: bytes) -> str:
+    """Encode image bytes as a data URL, with a single bytes→str decode at the end."""
+    return (b"data:" + mime.encode("ascii") + b";base64," + b64encode(img)).decode("ascii")
+
+def _downscale(img_bytes: bytes, mime: str) -> tuple[bytes, str]:
+    """Shrink an image to CAPTURE_MAX_EDGE (Lanczos) and re-encode as PNG.
+
+    Images already within the limit are returned untouched, mime included. Raises
+    ValueError for images over CAPTURE_MAX_PIXELS.
+    """
+    # Image.open only parses the header, so captures within the limit never pay for a pixel decode
+    img = Image.open(io.BytesIO(img_bytes))
+    if max(img.size) <= CAPTURE_MAX_EDGE:
+        return img_bytes, mime
+    if img.size[0] * img.size[1] > CAPTURE_MAX_PIXELS:
+        raise ValueError("Image too large")
+    if img.format == "JPEG":
+        # Let the JPEG decoder scale down by up to 8x while decoding, so far fewer pixels are produced
+        img.draft("RGB", (CAPTURE_MAX_EDGE, CAPTURE_MAX_EDGE))
+    img.thumbnail((CAPTURE_MAX_EDGE, CAPTURE_MAX_EDGE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, "PNG", optimize=True)  # PNG keeps alpha, which the edit endpoint accepts
+    return buf.getvalue(), "image/png"
 
 # -------------------
 # Routes — Page 1: Camera
@@ -130,28 +647,50 @@ def camera():
 
 @app.route("/capture", methods=["POST"])
 def capture():
-    """Accept a data URL from the front-end camera and stash bytes in memory.
+    """Accept a photo from the front-end camera and spool it for this session.
 
-    Expects { imageData: "data:image/<type>;base64,<...>" }
+    Expects either a raw image body (Content-Type: image/*, e.g. from canvas.toBlob),
+    which skips JSON parsing and base64 entirely, or
+    { imageData: "data:image/<type>;base64,<...>" }.
     """
-    sid = get_sid()
-    data = (request.json or {}).get("imageData")
+    sid, store = get_sid()
+    if request.mimetype.startswith("image/"):
+        img_bytes = request.get_data(cache=False)
+        mime = request.mimetype
+        if not img_bytes:
+            return jsonify({"ok": False, "error": "Invalid image data"}), 400
+    else:
+        data = (request.json or {}).get("imageData")
+
+        # Validate minimal shape of data URL to avoid decoding untrusted junk
+        if not data or data[:11] != "data:image/":
+            return jsonify({"ok": False, "error": "Invalid image data"}), 400
+
+        # The header is short: look for the header/payload boundary only near the start (a
+        # malformed payload isn't scanned end to end), then slice instead of split() copies
+        comma = data.find(",", 11, 64)
+        if comma < 0:
+            return jsonify({"ok": False, "error": "Invalid image data"}), 400
+        try:
+            img_bytes = b64decode(data[comma + 1:], validate=True)
+        except Exception:
+            return jsonify({"ok": False, "error": "Bad base64 payload"}), 400
 
-    # Validate minimal shape of data URL to avoid decoding untrusted junk
-    if not data or not data.startswith("data:image/"):
-        return jsonify({"ok": False, "error": "Invalid image data"}), 400
+        # Example: header = "data:image/png;base64" → mime = "image/png" (skip the "data:" prefix)
+        semi = data.find(";", 5, comma)
+        mime = data[5:semi if semi >= 0 else comma]
 
-    header, b64 = data.split(",", 1)
     try:
-        img_bytes = base64.b64decode(b64)
+        img_bytes, mime = _downscale(img_bytes, mime)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     except Exception:
-        return jsonify({"ok": False, "error": "Bad base64 payload"}), 400
+        return jsonify({"ok": False, "error": "Unreadable image"}), 400
 
-    # Stash into the in-memory session bucket
-    STORE[sid]["captured_image"] = img_bytes
-    # Example: header = "data:image/png;base64" → mime = "image/png"
-    STORE[sid]["captured_mime"] = header.split(";")[0].split(":", 1)[1]
-    STORE[sid]["ts"] = time.time()
+    # Spool the bytes to disk; only the path stays in the session bucket
+    store.captured_path = _tmp_write(sid, "captured", img_bytes)
+    store.captured_mime = mime
+    STORE.ping(sid)
 
     return jsonify({"ok": True, "redirect": url_for("review")})
 
@@ -161,16 +700,12 @@ def capture():
 @app.route("/review")
 def review():
     """Render a quick preview of the captured image for user confirmation."""
-    sid = get_sid()
-    img = STORE.get(sid, {}).get("captured_image")
-    mime = STORE.get(sid, {}).get("captured_mime", "image/png")
-    if not img:
+    _, store = get_sid()
+    if not store.captured_path:
         # If no image in session (e.g., refresh/new session), send back to camera
         return redirect(url_for("camera"))
-    # Convert bytes back into a data URL for <img src="...">
-    b64 = base64.b64encode(img).decode("ascii")
-    data_url = f"data:{mime};base64,{b64}"
-    return render_template("review.html", image_data=data_url)
+    # The page loads the photo from /img/captured/0, so no base64 work per render
+    return render_template("review.html")
 
 # -------------------
 # Routes — Page 3: Style Selection
@@ -178,196 +713,444 @@ def review():
 @app.route("/style", methods=["GET", "POST"])
 def style_select():
     """Either show the style selection page (GET) or accept a chosen style (POST)."""
-    sid = get_sid()
-    store = STORE.get(sid, {})
-    img = store.get("captured_image")
-    mime = store.get("captured_mime", "image/png")
-    if not img:
+    _, store = get_sid()
+    if not store.captured_path:
         return redirect(url_for("camera"))
 
     if request.method == "POST":
         selected = (request.json or {}).get("style")
-        if selected not in STYLE_PROMPTS:
+        meta = STYLE_META.get(selected)
+        if meta is None:
             return jsonify({"ok": False, "error": "Invalid style"}), 400
         # Persist selected style for later steps
-        store["selected_style"] = selected
-        store["selected_prompt"] = STYLE_PROMPTS[selected]
+        store.selected_style = selected
+        store.selected_prompt = meta["base_prompt"]
         # Move to the multi-prompt page where users can add up to 4 tweaks
         return jsonify({"ok": True, "redirect": url_for("multi_prompts")})
 
-    # GET: re-render the photo and show style options; remember previously chosen style if any
-    b64 = base64.b64encode(img).decode("ascii")
-    data_url = f"data:{mime};base64,{b64}"
-    return render_template("style.html", image_data=data_url, preselected=store.get("selected_style"))
+    # GET: show the photo (served by /img) and style options; remember previously chosen style if any
+    return render_template("style.html", preselected=store.selected_style)
 
 # -------------------
 # Routes — Page 4: Multi-Prompt page
 # -------------------
 @app.route("/multi")
 def multi_prompts():
-    """Display UI for four sequential generations with a base style + per-image additions."""
-    sid = get_sid()
-    store = STORE.get(sid, {})
-    if not store.get("captured_image"):
+    """Display UI for four generations with a base style + per-image additions."""
+    _, store = get_sid()
+    if not store.captured_path:
         return redirect(url_for("camera"))
-    if not store.get("selected_style"):
+    if not store.selected_style:
         return redirect(url_for("style_select"))
-    style_key = store["selected_style"]
-    style_label = STYLE_KEY_TO_HUMAN.get(style_key, style_key)
-    base_prompt = store.get("selected_prompt") or STYLE_PROMPTS.get(style_key, "")
-    return render_template("multi.html", style_label=style_label, base_prompt=base_prompt)
+    return render_template("multi.html", **STYLE_META[store.selected_style])
 
 # -------------------
-# Background worker — sequentially generate 4 images
+# Background worker — generate 4 images concurrently
 # -------------------
 
-def _run_multi_generation(sid: str, base_prompt: str, style_key: str, img: bytes, mime: str, user_prompts: list[str]) -> None:
-    """Generate 4 images sequentially using OpenAI Image Edit, updating progress in STORE.
+def _merge_prompt(style_key: str, user_prompt: str) -> str:
+    """Append a per-image user tweak to the style's precomputed prompt prefix."""
+    return STYLE_PROMPT_PREFIX[style_key] + (user_prompt.strip() or "No additional requirement.")
 
-    This function is intentionally run in a background thread. It reads/writes
-    session-specific keys in STORE so the front-end can poll progress. If the
-    user cancels, we exit early by checking gen_status.
-    """
-    store = STORE.get(sid, {})
-    try:
-        store["gen_status"] = "running"
-        store["gen_progress"] = 0
-        store["gen_error"] = None
-
-        # A short prefix to guide consistent sticker output across styles
-        sys_prefix = (
-            "You are an expert sticker-maker. Produce one high-quality PNG suitable for printing stickers. "
-            "Prefer transparent backgrounds when applicable. Keep the subject centered and sharp."
-        )
+def _extract_b64(resp) -> str | None:
+    """Pull the first image's base64 out of an edit response, or None.
 
-        images_out: list[bytes] = []
-        for i in range(4):
-            # Early cancel check — if /api/gen-cancel flips the status, stop work
-            if STORE.get(sid, {}).get("gen_status") == "canceled":
+    The SDK has multiple shapes depending on version; each is probed with getattr
+    chains, so neither a hit nor a miss raises (and allocates) an exception.
+    """
+    data = getattr(resp, "data", None)
+    if data:
+        gen_b64 = getattr(data[0], "b64_json", None)
+        if gen_b64:
+            return gen_b64
+    out = getattr(resp, "output", None) or getattr(resp, "outputs", None)
+    if not out:
+        return None
+    content = getattr(out[0], "content", None) or ()
+    for c in content:
+        if getattr(c, "type", None) in ("output_image", "image"):
+            gen_b64 = getattr(c, "image_base64", None) or getattr(c, "b64_json", None)
+            if gen_b64:
+                return gen_b64
+    # Oldest shape: output[0].content[0].image.base64
+    if content:
+        return getattr(getattr(content[0], "image", None), "base64", None)
+    return None
+
+def _read_file(path: str) -> bytes:
+    """Read a whole spooled file (called via asyncio.to_thread from the generation loop)."""
+    with open(path, "rb") as f:
+        return f.read()
+
+def _cancel_job(store: Session) -> None:
+    """Stop the session's generation job, if any, whether queued or mid-generation."""
+    future = store.gen_future
+    if future is not None:
+        # Thread-safe: cancels the job's task on GEN_LOOP, aborting any in-flight edits
+        future.cancel()
+    if store.batch_id:
+        try:
+            client.batches.cancel(store.batch_id)
+        except Exception:
+            # Best effort: the batch may already be finished or failed
+            pass
+
+async def _run_multi_generation(sid: str, store: Session, job_key: tuple, style_key: str, img_path: str, mime: str, user_prompts: list[str]) -> None:
+    """Generate 4 images concurrently using OpenAI Image Edit, updating progress on `store`.
+
+    Runs as a task on GEN_LOOP: all four edits are in flight at once (bounded by
+    GEN_CONCURRENCY), and progress is written to the session's record so the
+    front-end can poll it. /api/gen-cancel cancels the task, which drops it while it
+    waits for a job slot or aborts its in-flight edits. `job_key` is the job's
+    store.gen_key; once a newer job or a cancel has changed it, this job leaves the
+    session's status and results alone.
+    """
+    async with GEN_JOB_SLOTS:
+        if store.gen_key != job_key:
+            # Canceled or replaced while waiting for a slot
+            return
+        try:
+            store.gen_status = "running"
+            store.gen_progress = 0
+            store.gen_error = None
+            store.notify()
+
+            # Read the spooled photo once; the bytes live only for the duration of this job.
+            # (A shared file handle can't be used: the 4 uploads read concurrently.)
+            # Disk I/O and decoding run on worker threads so the loop keeps serving other jobs.
+            if _stage_alternate(sid, store, job_key):
+                # "Try again" with variants left over from the last job: no new edits needed
                 return
-
-            # Merge base style guidance with per-image user tweak
-            merged_prompt = (
-                f"{sys_prefix}\n"
-                f"Style: {STYLE_KEY_TO_HUMAN.get(style_key, style_key)}\n"
-                f"Instructions: {base_prompt}\n\n"
-                f"Additional requirement: {user_prompts[i].strip() or 'No additional requirement.'}"
-            )
-
+            img = await asyncio.to_thread(_read_file, img_path)
+            outputs = await _generate_all(store, job_key, style_key, img, user_prompts)
+            await asyncio.to_thread(_stage_results, sid, store, job_key, outputs)
+            await asyncio.to_thread(_gen_cache_evict)
+        except Exception as e:
+            # Any exception is surfaced to the polling endpoint so the UI can display it,
+            # unless the job was superseded meanwhile (its status belongs to the newer job)
+            if store.gen_key == job_key:
+                store.gen_status = "error"
+                store.gen_error = str(e)
+                store.notify()
+
+def _stage_results(sid: str, store: Session, job_key: tuple, outputs: list[list[str]]) -> None:
+    """Spool the 4 generated PNGs (and any extra variants) for the print flow; mark the job done.
+
+    `outputs` holds each image's base64 variants; the first is shown, the rest are kept
+    for "try again". Each image is decoded exactly once here; /img then serves the files
+    as raw bytes.
+    """
+    if sid not in STORE:
+        # Session expired or was evicted mid-job; don't respool files nobody will clean up
+        return
+    if store.gen_key != job_key:
+        # A newer job replaced this one, or a cancel (which clears gen_key) landed after
+        # staging started on its thread
+        return
+    paths = [_tmp_write(sid, f"generated-{i}", b64decode(v[0])) for i, v in enumerate(outputs)]
+    alts = [
+        [_tmp_write(sid, f"generated-{i}-{n}", b64decode(b)) for n, b in enumerate(v[1:], 1)]
+        for i, v in enumerate(outputs)
+    ]
+    if store.gen_key != job_key:
+        # Canceled or replaced while the files were being written
+        return
+    store.generated_alt, store.generated_key = alts, job_key
+    _show_results(sid, store, paths)
+
+def _stage_alternate(sid: str, store: Session, job_key: tuple) -> bool:
+    """Show the next spooled variant of each image for a retry; False once they've run out."""
+    alts = store.generated_alt
+    if store.gen_key != job_key or store.generated_key != job_key or not alts or not all(alts):
+        return False
+    _show_results(sid, store, [a.pop(0) for a in alts])
+    return True
+
+def _show_results(sid: str, store: Session, paths: list[str]) -> None:
+    """Point the print flow at the given spooled images and mark the job as done."""
+    store.generated_paths = paths
+    store.generated_mime = "image/png"
+    store.approved_paths = paths  # auto-approve all for print page
+    store.approved_mime = "image/png"
+    # New URL version per job, so browsers may cache approved images without ever going stale
+    store.approved_version = str(time.time_ns())
+    store.gen_progress = 100
+    store.gen_status = "done"
+    store.notify()
+    STORE.ping(sid)
+
+async def _generate_all(store: Session, job_key: tuple, style_key: str, img: bytes, user_prompts: list[str]) -> list[list[str]]:
+    """Fire the 4 image edits concurrently and return each one's base64 PNG variants in prompt order.
+
+    If the job is canceled or one edit fails, the other edits are cancelled too,
+    tearing down their in-flight HTTP requests.
+    """
+    sem = asyncio.Semaphore(GEN_CONCURRENCY)
+    completed = 0
+
+    cache_dir = _gen_cache_dir(img, style_key, user_prompts, GEN_SIZE)
+    # A "try again" whose spooled variants ran out wants fresh images, not the cached ones
+    use_cached = store.generated_key != job_key
+    # One upload tuple shared by all 4 edits; the bytes are never copied on our side
+    image_arg = [("input.png", img)]
+
+    async def one(i: int) -> list[str]:
+        nonlocal completed
+        variants = await asyncio.to_thread(_gen_cache_get, cache_dir, i) if use_cached else None
+        if variants:
+            # Same photo, style, prompt and size as an earlier job: reuse its output
+            completed += 1
+            store.gen_progress = int((completed / 4) * 100)
+            store.notify()
+            return variants
+
+        async with sem:
             # Perform image edit using the captured photo bytes
-            resp = client.images.edit(
+            resp = await aclient.images.edit(
                 model="gpt-image-1",
-                image=[("input.png", img)],  # single image edit in bytes form
-                prompt=merged_prompt,
-                size=os.environ.get("GEN_SIZE", "1024x1024"),
+                image=image_arg,  # single image edit in bytes form
+                prompt=_merge_prompt(style_key, user_prompts[i]),
+                size=GEN_SIZE,
+                n=GEN_VARIANTS,
             )
 
-            # The SDK has multiple shapes depending on version; extract base64 robustly
-            gen_b64 = None
-            try:
-                gen_b64 = resp.data[0].b64_json
-            except Exception:
-                pass
-            if not gen_b64:
-                try:
-                    out = getattr(resp, "output", None) or getattr(resp, "outputs", None) or []
-                    if out:
-                        content = getattr(out[0], "content", None) or []
-                        for c in content:
-                            if getattr(c, "type", None) in ("output_image", "image"):
-                                gen_b64 = getattr(c, "image_base64", None) or getattr(c, "b64_json", None)
-                                if gen_b64:
-                                    break
-                except Exception:
-                    pass
-            if not gen_b64:
-                try:
-                    gen_b64 = resp.output[0].content[0].image.base64  # type: ignore[attr-defined]
-                except Exception:
-                    pass
-            if not gen_b64:
-                # If the SDK returns a non-standard shape, surface a clear error to the UI
-                raise RuntimeError("No image returned from model")
-
-            # Convert to raw PNG bytes and collect
-            images_out.append(base64.b64decode(gen_b64))
-
-            # Update progress in 25% increments (after each of the 4 images)
-            STORE[sid]["gen_progress"] = int(((i + 1) / 4) * 100)
-
-        # On success, stage results for print flow and mark as done
-        store["generated_images"] = images_out
-        store["generated_mime"] = "image/png"
-        store["approved_images"] = images_out  # auto-approve all for print page
-        store["approved_mime"] = "image/png"
-        store["gen_status"] = "done"
-        store["ts"] = time.time()
-    except Exception as e:
-        # Any exception is surfaced to the polling endpoint so the UI can display it
-        store["gen_status"] = "error"
-        store["gen_error"] = str(e)
+        gen_b64 = _extract_b64(resp)
+        if not gen_b64:
+            # If the SDK returns a non-standard shape, surface a clear error to the UI
+            raise RuntimeError("No image returned from model")
+        # With GEN_VARIANTS > 1 the alternates come back in the same response
+        variants = [gen_b64] + [d.b64_json for d in (getattr(resp, "data", None) or [])[1:] if d.b64_json]
+        await asyncio.to_thread(_gen_cache_put, cache_dir, i, variants)
+
+        # Update progress in 25% increments as each edit completes (in any order);
+        # all tasks share one event loop thread, so the counter needs no lock
+        completed += 1
+        store.gen_progress = int((completed / 4) * 100)
+        store.notify()
+        return variants
+
+    tasks = [asyncio.create_task(one(i)) for i in range(4)]
+    try:
+        return await asyncio.gather(*tasks)  # re-raises the first failed edit
+    finally:
+        # On cancel or failure, abort whatever is still in flight
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# -------------------
+# Batch API path (opt-in via USE_BATCH_API)
+# -------------------
+
+def _submit_batch(style_key: str, image_url: str, user_prompts: list[str]) -> str:
+    """Upload a 4-line JSONL of image edits and start an OpenAI Batch job; return its id.
+
+    `image_url` is the captured photo as a data URL, embedded in every request line.
+    """
+    lines = []
+    for i in range(4):
+        lines.append(json.dumps({
+            "custom_id": f"img-{i}",  # used to restore prompt order from the output file
+            "method": "POST",
+            "url": "/v1/images/edits",
+            "body": {
+                "model": "gpt-image-1",
+                "images": [{"image_url": image_url}],
+                "prompt": _merge_prompt(style_key, user_prompts[i]),
+                "size": GEN_SIZE,
+            },
+        }))
+    jsonl = io.BytesIO("\n".join(lines).encode("utf-8"))
+    batch_file = client.files.create(file=("booth-batch.jsonl", jsonl), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/images/edits",
+        completion_window="24h",
+    )
+    return batch.id
+
+def _poll_batch(sid: str, store: Session) -> None:
+    """Refresh gen_status/gen_progress from the session's Batch job; stage images when complete."""
+    batch = client.batches.retrieve(store.batch_id)
+    if batch.status in ("validating", "in_progress", "finalizing"):
+        store.gen_status = "running"
+        counts = batch.request_counts
+        if counts and counts.total:
+            store.gen_progress = int((counts.completed / counts.total) * 100)
+        return
+    if batch.status != "completed" or not batch.output_file_id:
+        store.gen_status = "error"
+        store.gen_error = f"Batch {batch.status}"
+        return
+
+    # Output lines may arrive in any order; index them by custom_id
+    by_id: dict[str, str] = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        body = (row.get("response") or {}).get("body") or {}
+        data = body.get("data") or [{}]
+        if data[0].get("b64_json"):
+            by_id[row.get("custom_id")] = data[0]["b64_json"]
+    if len(by_id) != 4:
+        store.gen_status = "error"
+        store.gen_error = "No image returned from model"
+        return
+
+    _stage_results(sid, store, store.gen_key, [[by_id[f"img-{i}"]] for i in range(4)])
 
 # -------------------
 # API — start background generation & go to processing
 # -------------------
 @app.route("/api/generate-multi-start", methods=["POST"])
 def api_generate_multi_start():
-    """Kick off the background thread that sequentially produces 4 images.
+    """Queue the background job that concurrently produces 4 images.
 
     Expects JSON { prompts: [p0, p1, p2, p3] } where missing entries default to "".
     """
-    sid = get_sid()
-    store = STORE.get(sid, {})
+    sid, store = get_sid()
 
-    img = store.get("captured_image")
-    mime = store.get("captured_mime", "image/png")
-    style_key = store.get("selected_style")
-    base_prompt = store.get("selected_prompt")
+    img_path = store.captured_path
+    mime = store.captured_mime
+    style_key = store.selected_style
+    base_prompt = store.selected_prompt
 
     payload = request.json or {}
     # Always normalize to exactly 4 entries so loop indices are consistent
     user_prompts = (payload.get("prompts") or []) + ["", "", "", ""]
     user_prompts = user_prompts[:4]
 
-    if not img or not style_key or not base_prompt:
+    if not img_path or not style_key or not base_prompt:
+        return jsonify({"ok": False, "error": "Missing input"}), 400
+    try:
+        # The photo's mtime tells a retake apart from the same capture
+        job_key = (style_key, tuple(user_prompts), os.stat(img_path).st_mtime_ns)
+    except OSError:
         return jsonify({"ok": False, "error": "Missing input"}), 400
 
+    # A double-click or retry with the same inputs piggybacks on the job already in flight
+    future = store.gen_future
+    if (store.gen_key == job_key and store.gen_status in ("queued", "running")
+            and (future is None or not future.done())):
+        return jsonify({"ok": True, "redirect": url_for("processing")})
+    # Different inputs: stop the previous job so it can't overwrite this one's results
+    _cancel_job(store)
+    store.gen_key = job_key
+
     # Initialize status so the /processing page can immediately show a state
-    store["gen_status"] = "queued"
-    store["gen_progress"] = 0
-    store["gen_error"] = None
-
-    # Spawn the worker thread; daemon=True so it won't block shutdown in dev
-    t = threading.Thread(
-        target=_run_multi_generation,
-        args=(sid, base_prompt, style_key, img, mime, user_prompts),
-        daemon=True,
+    store.gen_status = "queued"
+    store.gen_progress = 0
+    store.gen_error = None
+    store.batch_id = None
+    store.gen_future = None
+    store.notify()
+
+    if USE_BATCH_API:
+        # Hand the whole job to OpenAI; /api/gen-status polls the batch instead of a thread
+        try:
+            image_url = _data_url(mime, _read_file(img_path))
+            store.batch_id = _submit_batch(style_key, image_url, user_prompts)
+        except Exception as e:
+            store.gen_status = "error"
+            store.gen_error = str(e)
+            return jsonify({"ok": False, "error": str(e)}), 502
+        return jsonify({"ok": True, "redirect": url_for("processing")})
+
+    # Schedule the job on the generation loop; keep the Future so a cancel can stop it
+    store.gen_future = asyncio.run_coroutine_threadsafe(
+        _run_multi_generation(sid, store, job_key, style_key, img_path, mime, user_prompts), GEN_LOOP
     )
-    t.start()
 
     return jsonify({"ok": True, "redirect": url_for("processing")})
 
 # -------------------
-# API — poll status / cancel
+# API — poll status / stream status / cancel
 # -------------------
+# Idle streams get a comment line this often so proxies don't time them out
+GEN_STREAM_HEARTBEAT_SECONDS = 15
+
+def _gen_status_payload(s: Session) -> dict:
+    return {
+        "ok": True,
+        "status": s.gen_status,
+        "progress": int(s.gen_progress),
+        "error": s.gen_error,
+    }
+
+def _refresh_batch(sid: str, s: Session) -> None:
+    """Pull progress for an in-flight batch job; no-op for jobs run from GEN_LOOP."""
+    if s.batch_id and s.gen_status in ("queued", "running"):
+        try:
+            _poll_batch(sid, s)
+        except Exception as e:
+            # Transient API errors shouldn't fail the job; the next poll retries
+            s.gen_error = str(e)
+
 @app.route("/api/gen-status")
 def api_gen_status():
     """Return the current status/progress/error for the user's generation job."""
-    sid = get_sid()
-    s = STORE.get(sid, {})
-    return jsonify({
-        "ok": True,
-        "status": s.get("gen_status", "idle"),
-        "progress": int(s.get("gen_progress", 0)),
-        "error": s.get("gen_error"),
-    })
+    sid, s = get_sid()
+    _refresh_batch(sid, s)
+    return jsonify(_gen_status_payload(s))
+
+@app.route("/api/gen-stream")
+def api_gen_stream():
+    """Server-sent events: push the job's status each time it changes, until it finishes.
+
+    One long-lived response replaces a poll request (cookie, session touch, JSON) every
+    ~1s. The job notifies the session's gen_changed condition on every status/progress
+    change, and the stream sleeps on it between events; it closes after a terminal
+    status or once the session is gone. Being one request, it pings the session itself
+    so the sweeper doesn't expire it mid-job.
+
+    Batch jobs get 204 (EventSource then stops): their status only moves when polled,
+    and a stream would sit on a thread for up to the batch window, so the client falls
+    back to /api/gen-status.
+
+    NOTE: each open stream holds a worker thread for the whole job. On a single sync
+    worker that blocks every other request (including /api/gen-cancel) until the job
+    ends, so run a threaded worker (e.g. gunicorn --threads) when serving this.
+    """
+    sid, s = get_sid()
+    if s.batch_id:
+        return Response(status=204)
+    # Wake at least this often to heartbeat and refresh the TTL well inside the sweeper's window
+    wait_for = min(GEN_STREAM_HEARTBEAT_SECONDS, STORE.ttl_seconds / 2)
+
+    def events():
+        last = None
+        while True:
+            with s.gen_changed:
+                # Read and wait under the condition's lock, so a notify can't slip in between
+                payload = _gen_status_payload(s)
+                if payload == last:
+                    s.gen_changed.wait(wait_for)
+                    payload = _gen_status_payload(s)
+            if sid not in STORE:
+                return
+            STORE.ping(sid)
+            if payload == last:
+                yield ": keep-alive\n\n"
+                continue
+            yield "data: " + app.json.dumps(payload) + "\n\n"
+            last = payload
+            if payload["status"] not in ("queued", "running"):
+                return
+
+    resp = Response(events(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # stop nginx from buffering the stream
+    return resp
 
 @app.route("/api/gen-cancel", methods=["POST"])
 def api_gen_cancel():
-    """Allow the user to cancel the current job; worker checks this flag between images."""
-    sid = get_sid()
-    s = STORE.get(sid, {})
-    s["gen_status"] = "canceled"
+    """Allow the user to cancel the current job, whether queued or mid-generation."""
+    _, s = get_sid()
+    s.gen_status = "canceled"
+    s.gen_key = None  # a job already staging its results on a thread then drops them
+    s.notify()
+    _cancel_job(s)
     return jsonify({"ok": True, "redirect": url_for("style_select")})
 
 # -------------------
@@ -375,16 +1158,13 @@ def api_gen_cancel():
 # -------------------
 @app.route("/processing")
 def processing():
-    """Show a progress UI while the background thread runs; redirects if prerequisites missing."""
-    sid = get_sid()
-    store = STORE.get(sid, {})
-    if not store.get("captured_image"):
+    """Show a progress UI while the background job runs; redirects if prerequisites missing."""
+    _, store = get_sid()
+    if not store.captured_path:
         return redirect(url_for("camera"))
-    if not store.get("selected_style"):
+    if not store.selected_style:
         return redirect(url_for("style_select"))
-    style_key = store["selected_style"]
-    style_label = STYLE_KEY_TO_HUMAN.get(style_key, style_key)
-    return render_template("processing.html", style_label=style_label)
+    return render_template("processing.html", **STYLE_META[store.selected_style])
 
 # -------------------
 # Routes — Print Layout (expects 4 images)
@@ -392,41 +1172,76 @@ def processing():
 @app.route("/print-layout")
 def print_layout():
     """Final layout page; requires 4 approved images prepared by the background worker."""
-    sid = get_sid()
-    store = STORE.get(sid, {})
-    if not store.get("approved_images"):
-        if store.get("selected_style"):
+    _, store = get_sid()
+    if not store.approved_paths:
+        if store.selected_style:
             return redirect(url_for("multi_prompts"))
         return redirect(url_for("style_select"))
     return render_template("print.html")
 
 @app.route("/api/approved-list")
 def api_approved_list():
-    """Return 4 data URLs for the approved images that the print page can render."""
-    sid = get_sid()
-    store = STORE.get(sid, {})
-    imgs = store.get("approved_images")
-    mime = store.get("approved_mime", "image/png")
-    if not imgs or len(imgs) != 4:
-        return jsonify({"ok": False, "error": "No approved images"}), 404
+    """Return URLs for the 4 approved images; the print page fetches each as a raw PNG.
 
-    data_urls: list[str] = []
-    for b in imgs:
-        b64 = base64.b64encode(b).decode("ascii")
-        data_urls.append(f"data:{mime};base64,{b64}")
-    return jsonify({"ok": True, "data_urls": data_urls})
+    Four small GETs instead of one giant JSON body: the browser downloads them in
+    parallel and the print page can start drawing as soon as the first arrives.
+    """
+    _, store = get_sid()
+    paths = store.approved_paths
+    if not paths or len(paths) != 4:
+        return jsonify({"ok": False, "error": "No approved images"}), 404
+    version = store.approved_version
+    urls = [url_for("session_image", kind="approved", idx=i, v=version) for i in range(4)]
+    return jsonify({"ok": True, "urls": urls})
+
+@app.route("/img/<kind>/<int:idx>")
+def session_image(kind: str, idx: int):
+    """Stream one of this session's images as raw bytes (no base64 data URL).
+
+    `kind` is "captured" (idx 0) or "approved" (idx 0–3). Lookups only ever use the
+    caller's own session, so one browser can't fetch another's images. Responses carry
+    an ETag and must be revalidated, so a retake never shows a stale cached photo —
+    except approved URLs carrying the current job version (?v=), which can't go stale
+    and are privately cacheable for 10 minutes.
+    """
+    _, store = get_sid()
+    path, mime = None, "image/png"
+    if kind == "captured" and idx == 0:
+        path, mime = store.captured_path, store.captured_mime
+    elif kind == "approved":
+        paths = store.approved_paths or []
+        if idx < len(paths):
+            path, mime = paths[idx], store.approved_mime
+    if not path or not os.path.exists(path):
+        return jsonify({"ok": False, "error": "Image not found"}), 404
+
+    versioned = kind == "approved" and request.args.get("v") == store.approved_version
+    # send_file marks the response no-cache unless it's given a max_age
+    resp = send_file(path, mimetype=mime, conditional=True, etag=True,
+                     max_age=600 if versioned else None)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
 
 # -------------------
-# Printer utils (unchanged)
+# Printer utils
 # -------------------
+# Resolve CUPS binaries once at startup: saves a $PATH scan per request, and passing the
+# absolute path as argv[0] skips the exec-time path search too. Restart after installing CUPS.
+LP_BIN = shutil.which("lp")
+LPSTAT_BIN = shutil.which("lpstat")
+
+# First 8 bytes of every PNG; a raw print body must start with these
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
 @app.route("/printer-info")
 def printer_info():
     """Expose simple CUPS status so the UI can show which printers (if any) are usable."""
     info = {"available": False, "default": None, "raw": None}
-    if shutil.which("lpstat"):
+    if LPSTAT_BIN:
         try:
             out = subprocess.check_output(
-                ["lpstat", "-p", "-d"], stderr=subprocess.STDOUT
+                [LPSTAT_BIN, "-p", "-d"], stderr=subprocess.STDOUT
             ).decode("utf-8", "ignore")
             info["raw"] = out
             default = None
@@ -445,42 +1260,86 @@ def printer_info():
 def print_direct():
     """Send a PNG sheet directly to the default CUPS printer using `lp`.
 
+    Accepts either a raw PNG body (Content-Type: image/png, e.g. from canvas.toBlob),
+    which is streamed to `lp` with no base64 step at all, or the legacy JSON
+    { sheet: "data:image/png;base64,<...>" } for clients that can't send binary.
+
     This is optional—users can also use the browser's Print dialog on the print page.
     """
-    if not shutil.which("lp"):
+    if not LP_BIN:
         return jsonify({"ok": False, "error": "Direct print not available (lp not found). Use browser Print."}), 400
 
-    sid = get_sid()
-    store = STORE.get(sid, {})
-    data_url = (request.json or {}).get("sheet")
-    if not data_url or not data_url.startswith("data:image/png;base64,"):
-        return jsonify({"ok": False, "error": "Invalid sheet payload"}), 400
+    sid, store = get_sid()
+    sheet_path = None
+    if request.mimetype == "image/png":
+        # The length is needed to tell a complete upload from one cut short mid-stream
+        if not request.content_length:
+            return jsonify({"ok": False, "error": "Content-Length required"}), 400
+        # Check the signature up front; the rest of the body goes straight from the socket to lp
+        head = request.stream.read(len(PNG_SIGNATURE))
+        if head != PNG_SIGNATURE:
+            return jsonify({"ok": False, "error": "Invalid sheet payload"}), 400
+    else:
+        data_url = (request.json or {}).get("sheet")
+        prefix = "data:image/png;base64,"
+        if not data_url or not data_url.startswith(prefix):
+            return jsonify({"ok": False, "error": "Invalid sheet payload"}), 400
 
-    b64 = data_url.split(",", 1)[1]
-    try:
-        png_bytes = base64.b64decode(b64)
-    except Exception:
-        return jsonify({"ok": False, "error": "Bad base64 payload"}), 400
+        try:
+            # Decode past the fixed-length prefix straight into the session spool
+            sheet_path = _tmp_write_b64(sid, "sheet", data_url, start=len(prefix))
+        except Exception:
+            return jsonify({"ok": False, "error": "Bad base64 payload"}), 400
+        head = b""
 
+    proc = None
     try:
-        proc = subprocess.run(
-            ["lp", "-o", "media=A4", "-o", "fit-to-page"],
-            input=png_bytes,
+        proc = subprocess.Popen(
+            [LP_BIN, "-o", "media=A4", "-o", "fit-to-page"],
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
+        # Stream the sheet (from the spool or the request body) in 64 KB chunks rather than
+        # buffering it whole for the pipe
+        src = open(sheet_path, "rb") if sheet_path else request.stream
+        written = 0
+        lp_exited = False
+        try:
+            proc.stdin.write(head)
+            written += len(head)
+            while chunk := src.read(64 * 1024):
+                proc.stdin.write(chunk)
+                written += len(chunk)
+        except BrokenPipeError:
+            # lp exited early; its output below says why
+            lp_exited = True
+        except ClientDisconnected:
+            # Upload cut short; the length check below stops lp
+            pass
+        finally:
+            if sheet_path:
+                src.close()
+        if not sheet_path and not lp_exited and written != request.content_length:
+            # Body cut short: kill lp before stdin closes so it never queues a partial sheet
+            proc.kill()
+            proc.wait()
+            return jsonify({"ok": False, "error": "Incomplete sheet upload"}), 400
+        out, _ = proc.communicate()  # closes stdin and waits for lp to finish spooling
+        if sheet_path:
+            os.remove(sheet_path)
         if proc.returncode != 0:
-            return jsonify({"ok": False, "error": proc.stdout.decode("utf-8", "ignore")}), 500
+            return jsonify({"ok": False, "error": out.decode("utf-8", "ignore")}), 500
 
         # On success, aggressively free memory for this session (no lingering PII/media)
-        for key in [
-            "captured_image", "generated_images", "approved_images",
-            "selected_style", "selected_prompt", "generated_mime",
-            "approved_mime", "ts", "gen_status", "gen_progress", "gen_error"
-        ]:
-            store.pop(key, None)
-        return jsonify({"ok": True, "message": proc.stdout.decode("utf-8", "ignore")})
+        store.reset()
+        _tmp_drop(sid)
+        return jsonify({"ok": True, "message": out.decode("utf-8", "ignore")})
     except Exception as e:
+        # e.g. the client disconnected mid-upload; don't let lp print what arrived so far
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
         return jsonify({"ok": False, "error": str(e)}), 500
 
 # -------------------
@@ -494,20 +1353,19 @@ def too_large(_):
 @app.route("/reset", methods=["POST"])
 def reset():
     """Hard-reset the session store for this browser; use when starting over."""
-    sid = session.get("sid")
-    if sid and sid in STORE:
-        del STORE[sid]
-    session.clear()
-    return jsonify({"ok": True, "redirect": url_for("camera")})
+    sid = _cookie_sid()
+    state = STORE.pop(sid) if sid else None
+    if state is not None:
+        # Stops a job still in flight, then deletes the session's files
+        _evict([(sid, state)])
+    resp = jsonify({"ok": True, "redirect": url_for("camera")})
+    resp.delete_cookie(SID_COOKIE)
+    return resp
 
 @app.route("/start-new", methods=["POST"])
 def start_new():
     """Alias for /reset to make the intent clearer from the UI layer."""
-    sid = session.get("sid")
-    if sid and sid in STORE:
-        del STORE[sid]
-    session.clear()
-    return jsonify({"ok": True, "redirect": url_for("camera")})
+    return reset()
 
 # -------------------
 # Entrypoint
@@ -194,13 +194,14 @@
 
     ctx.clearRect(0, 0, cw, ch);
     ctx.drawImage(video, sx, sy, sw, sh, 0, 0, cw, ch);
-    const dataUrl = canvas.toDataURL('image/png');
 
     try {
+      // Send the PNG as a raw binary body: no base64 inflation, no JSON parse on the server
+      const blob = await new Promise((resolve) => canvas.toBlob(resolve, 'image/png'));
       const res = await fetch('/capture', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ imageData: dataUrl })
+        headers: { 'Content-Type': 'image/png' },
+        body: blob
       });
       const json = await res.json();
       if (json.ok) {
@@ -8,14 +8,14 @@
   if (!canvas || !preview) return;
   const ctx = canvas.getContext('2d');
 
-  // Fetch the 4 approved images
-  let dataUrls = [];
+  // Fetch the URLs of the 4 approved images (served as raw PNGs, not data URLs)
+  let imageUrls = [];
   try {
     const res = await fetch('/api/approved-list');
     const json = await res.json();
     if (!json.ok) throw new Error(json.error || 'Failed to load images.');
-    dataUrls = json.data_urls || [];
-    if (dataUrls.length !== 4) throw new Error('Expected 4 images.');
+    imageUrls = json.urls || [];
+    if (imageUrls.length !== 4) throw new Error('Expected 4 images.');
   } catch (err) {
     console.error(err);
     alert('Could not load images for printing. Returning to prompts.');
@@ -45,19 +45,6 @@
   ctx.fillStyle = '#ffffff';
   ctx.fillRect(0, 0, W, H);
 
-  // Load all images
-  const imgs = await Promise.all(
-    dataUrls.map(
-      (src) =>
-        new Promise((resolve, reject) => {
-          const im = new Image();
-          im.onload = () => resolve(im);
-          im.onerror = reject;
-          im.src = src;
-        })
-    )
-  );
-
   // Draw preserving aspect ratio
   const positions = [
     [marginX, marginY],                                    // top-left
@@ -66,7 +53,7 @@
     [marginX + cellW + gutterX, marginY + cellH + gutterY] // bottom-right
   ];
 
-  imgs.forEach((im, i) => {
+  function drawCell(im, i) {
     const [x, y] = positions[i];
     const scale = Math.min(cellW / im.width, cellH / im.height);
     const drawW = Math.round(im.width * scale);
@@ -74,7 +61,23 @@
     const offsetX = x + Math.floor((cellW - drawW) / 2);
     const offsetY = y + Math.floor((cellH - drawH) / 2);
     ctx.drawImage(im, offsetX, offsetY, drawW, drawH);
-  });
+  }
+
+  // Load all images in parallel; each is drawn into its cell as soon as it arrives
+  await Promise.all(
+    imageUrls.map(
+      (src, i) =>
+        new Promise((resolve, reject) => {
+          const im = new Image();
+          im.onload = () => {
+            drawCell(im, i);
+            resolve();
+          };
+          im.onerror = reject;
+          im.src = src;
+        })
+    )
+  );
 
   // Update the screen preview
   const pngUrl = canvas.toDataURL('image/png');
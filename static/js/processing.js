@@ -8,6 +8,7 @@
   let visualProgress = 0; // smooth client-side progress
   let targetProgress = 0; // server-reported progress
   let polling = true;
+  let finished = false; // set once a terminal status arrives
 
   function render() {
     const diff = targetProgress - visualProgress;
@@ -24,34 +25,58 @@
     if (polling) requestAnimationFrame(render);
   }
 
+  // Apply one status update; returns true once the job has finished
+  function handle(json) {
+    if (!json.ok) throw new Error('Bad status');
+
+    targetProgress = Number(json.progress || 0);
+
+    if (json.status === 'done') {
+      targetProgress = 100;
+      finished = true;
+      setTimeout(() => (window.location.href = '/print-layout'), 250);
+      return true;
+    }
+    if (json.status === 'error') {
+      finished = true;
+      alert('Generation failed: ' + (json.error || 'Unknown error'));
+      window.location.href = '/multi';
+      return true;
+    }
+    if (json.status === 'canceled') {
+      finished = true;
+      window.location.href = '/style';
+      return true;
+    }
+    return false;
+  }
+
   async function poll() {
     try {
       const res = await fetch('/api/gen-status');
-      const json = await res.json();
-      if (!json.ok) throw new Error('Bad status');
-
-      targetProgress = Number(json.progress || 0);
-
-      if (json.status === 'done') {
-        targetProgress = 100;
-        setTimeout(() => (window.location.href = '/print-layout'), 250);
-        return;
-      }
-      if (json.status === 'error') {
-        alert('Generation failed: ' + (json.error || 'Unknown error'));
-        window.location.href = '/multi';
-        return;
-      }
-      if (json.status === 'canceled') {
-        window.location.href = '/style';
-        return;
-      }
+      if (handle(await res.json())) return;
     } catch (e) {
       console.error(e);
       // keep trying
-    } finally {
-      if (polling) setTimeout(poll, 1200);
     }
+    if (!finished) setTimeout(poll, 1200);
+  }
+
+  // Prefer one server-sent event stream; fall back to polling if it isn't available
+  function listen() {
+    if (!window.EventSource) return poll();
+    const es = new EventSource('/api/gen-stream');
+    es.onmessage = (ev) => {
+      try {
+        if (handle(JSON.parse(ev.data))) es.close();
+      } catch (e) {
+        console.error(e);
+      }
+    };
+    es.onerror = () => {
+      es.close();
+      if (!finished) poll();
+    };
   }
 
   if (cancelBtn) {
@@ -67,5 +92,5 @@
   }
 
   requestAnimationFrame(render);
-  poll();
+  listen();
 })();